@@ -1,13 +1,19 @@
-import subprocess
 import time
-import csv
-import datetime
+import atexit
+import signal
+import sys
 import argparse
 import os
-import sys
 import logging
 import configparser
-from pynvml import *
+import ctypes
+import queue
+import threading
+import collections
+import errno
+from pynvml import (nvmlInit, nvmlShutdown, nvmlDeviceGetHandleByIndex, nvmlDeviceGetPciInfo,
+                    nvmlDeviceGetPersistenceMode, nvmlDeviceSetPersistenceMode, NVMLError,
+                    NVML_SUCCESS, NVML_TEMPERATURE_GPU, NVML_FEATURE_ENABLED)
 
 
 # Parse command line arguments
@@ -18,166 +24,719 @@ parser.add_argument('--min-pwm-value', type=int, default=0, help='Minimum PWM Va
 parser.add_argument('--max-pwm-value', type=int, default=255, help='Maximum PWM Value for fan speed 0-255 value (default: 255)')
 parser.add_argument('--pwm-step', type=int, default=5, help='The PWM value step size for adjusting fan speed (default: 5)')
 parser.add_argument('--temp-drop', type=int, default=3, help='Temperature drop threshold for fan speed reduction (default: 3)')
+parser.add_argument('--temp-rise', type=int, default=0, help='Temperature rise threshold for fan speed increase (default: 0)')
+parser.add_argument('--gpu-index', type=int, default=1, help='NVML index of the GPU to monitor (default: 1)')
 parser.add_argument('--config', type=str, default='/etc/baram/baram.conf', help='Path to configuration file')
 parser.add_argument('--wattage-threshold', type=int, default=240, help='Wattage threshold for triggering increased fan speed (default: 240)')
 parser.add_argument('--wattage-pwm-value', type=int, default=125, help='PWM value to set when wattage spike conditions are met (default: 125)')
-parser.add_argument('--wattage-spike-count', type=int, default=3, help='Number of consecutive wattage spikes to trigger increased fan speed (default: 3)')
-
-args = parser.parse_args()
+parser.add_argument('--wattage-spike-count', type=int, default=3, help='Number of wattage spikes within the wattage interval to trigger increased fan speed (default: 3)')
+parser.add_argument('--wattage-interval', type=float, default=30, help='Window in seconds over which wattage spikes are counted (default: 30)')
+parser.add_argument('--sleep-interval', type=float, default=2, help='Interval in seconds between temperature checks (default: 2)')
+parser.add_argument('--max-sleep-interval', type=float, default=10, help='Longest interval in seconds between temperature checks while readings are steady (default: 10)')
+parser.add_argument('--temp-smoothing', type=float, default=0.3, help='Weight of the newest reading in the smoothed temperature used for fan control, 1 disables smoothing (default: 0.3)')
+parser.add_argument('--fan-control', type=str, default='curve', choices=['curve', 'pi'], help='Fan control method: temperature curve or PI controller (default: curve)')
+parser.add_argument('--pi-target-temp', type=int, default=None, help='Temperature the PI controller holds the GPU at (default: midpoint of min and max temp)')
+parser.add_argument('--pi-kp', type=float, default=5.0, help='PI controller proportional gain in PWM per degree (default: 5.0)')
+parser.add_argument('--pi-ki', type=float, default=0.05, help='PI controller integral gain in PWM per degree second (default: 0.05)')
+parser.add_argument('--pwm-hysteresis', type=int, default=3, help='Minimum PWM change before a new value is written to the fan (default: 3)')
+parser.add_argument('--restore-pwm-mode', type=int, default=2, help='PWM control mode to restore on exit if the fan was already in manual mode at startup (default: 2, automatic)')
+parser.add_argument('--no-persistence-mode', action='store_true', help='Do not enable NVIDIA persistence mode on the monitored GPU')
+parser.add_argument('--no-rt', action='store_true', help='Do not run the control loop with realtime priority and locked memory')
+parser.add_argument('--log-level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Logging level for baram.log (default: INFO)')
+
+cli_args = parser.parse_args()
 
 # Setup logging
-logging.basicConfig(filename="/var/log/baram/baram.log", level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(filename="/var/log/baram/baram.log", level=getattr(logging, cli_args.log_level), format='%(asctime)s - %(levelname)s - %(message)s')
 data_log_file = "/var/log/baram/baram.out"
 
-# Read configuration file
-config = configparser.ConfigParser()
-config.read(args.config)
-
-# Update arguments from configuration file
-args.min_temp = config.getint('Settings', 'min_temp', fallback=args.min_temp)
-args.max_temp = config.getint('Settings', 'max_temp', fallback=args.max_temp)
-args.min_pwm_value = config.getint('Settings', 'min_pwm_value', fallback=args.min_pwm_value)
-args.max_pwm_value = config.getint('Settings', 'max_pwm_value', fallback=args.max_pwm_value)
-args.wattage_threshold = config.getint('Settings', 'wattage_threshold', fallback=args.wattage_threshold)
-args.wattage_pwm_value = config.getint('Settings', 'wattage_pwm_value', fallback=args.wattage_pwm_value)
-args.sleep_interval = config.getint('Settings', 'sleep_interval', fallback=2)
-args.wattage_spike_count = config.getint('Settings', 'wattage_spike_count', fallback=3)
-
-def log_data(data):
-    with open(data_log_file, "a") as file:
-        writer = csv.writer(file)
-        writer.writerow(data)
-
-MIN_TEMP = args.min_temp
-MAX_TEMP = args.max_temp
-MIN_PWM = args.min_pwm_value
-MAX_PWM = args.max_pwm_value
-TEMP_DROP = args.temp_drop
-
-# Define temperature and corresponding PWM values
-TEMP_THRESHOLDS = [30, 40, 50, 60, 70, MAX_TEMP]
-PWM_RANGES = [(0, 0), (0, 30), (30, 60), (60, 90), (90, 120), (120, MAX_PWM)]
+# First temperature threshold of the fan curve, max_temp has to be above it
+TEMP_CURVE_START = 30
+
+def load_settings(cli_args):
+    # Read configuration file, values in it override the command line arguments
+    config = configparser.ConfigParser()
+    config.read(cli_args.config)
+
+    settings = argparse.Namespace(**vars(cli_args))
+    settings.gpu_index = config.getint('Settings', 'gpu_index', fallback=settings.gpu_index)
+    settings.min_temp = config.getint('Settings', 'min_temp', fallback=settings.min_temp)
+    settings.max_temp = config.getint('Settings', 'max_temp', fallback=settings.max_temp)
+    settings.min_pwm_value = config.getint('Settings', 'min_pwm_value', fallback=settings.min_pwm_value)
+    settings.max_pwm_value = config.getint('Settings', 'max_pwm_value', fallback=settings.max_pwm_value)
+    settings.wattage_threshold = config.getint('Settings', 'wattage_threshold', fallback=settings.wattage_threshold)
+    settings.wattage_pwm_value = config.getint('Settings', 'wattage_pwm_value', fallback=settings.wattage_pwm_value)
+    settings.sleep_interval = config.getfloat('Settings', 'sleep_interval', fallback=settings.sleep_interval)
+    settings.wattage_spike_count = config.getint('Settings', 'wattage_spike_count', fallback=settings.wattage_spike_count)
+    settings.wattage_interval = config.getfloat('Settings', 'wattage_interval', fallback=settings.wattage_interval)
+    settings.pwm_step = config.getint('Settings', 'pwm_step', fallback=settings.pwm_step)
+    settings.temp_drop = config.getint('Settings', 'temp_drop', fallback=settings.temp_drop)
+    settings.temp_rise = config.getint('Settings', 'temp_rise', fallback=settings.temp_rise)
+    settings.max_sleep_interval = config.getfloat('Settings', 'max_sleep_interval', fallback=settings.max_sleep_interval)
+    settings.max_sleep_interval = max(settings.max_sleep_interval, settings.sleep_interval)
+    settings.temp_smoothing = config.getfloat('Settings', 'temp_smoothing', fallback=settings.temp_smoothing)
+    settings.restore_pwm_mode = config.getint('Settings', 'restore_pwm_mode', fallback=settings.restore_pwm_mode)
+    settings.fan_control = config.get('Settings', 'fan_control', fallback=settings.fan_control)
+    settings.pi_target_temp = config.getint('Settings', 'pi_target_temp', fallback=settings.pi_target_temp)
+    if settings.pi_target_temp is None:
+        settings.pi_target_temp = (settings.min_temp + settings.max_temp) // 2
+    settings.pi_kp = config.getfloat('Settings', 'pi_kp', fallback=settings.pi_kp)
+    settings.pi_ki = config.getfloat('Settings', 'pi_ki', fallback=settings.pi_ki)
+    settings.pwm_hysteresis = config.getint('Settings', 'pwm_hysteresis', fallback=settings.pwm_hysteresis)
+    validate_settings(settings)
+    return settings
+
+def validate_settings(settings):
+    # The fan curve is precomputed into byte tables, so every PWM value has to fit the
+    # 0-255 range of pwm1 and the curve must not divide by zero
+    if not 0 <= settings.min_pwm_value <= settings.max_pwm_value <= 255:
+        raise ValueError(f"min_pwm_value ({settings.min_pwm_value}) and max_pwm_value ({settings.max_pwm_value}) must satisfy 0 <= min_pwm_value <= max_pwm_value <= 255")
+    if not 0 <= settings.wattage_pwm_value <= 255:
+        raise ValueError(f"wattage_pwm_value ({settings.wattage_pwm_value}) must be between 0 and 255")
+    if settings.max_temp <= TEMP_CURVE_START:
+        raise ValueError(f"max_temp ({settings.max_temp}) must be above {TEMP_CURVE_START}")
+    # Weight of the newest reading in the temperature EMA, 0 would freeze it at the first
+    # reading and values outside (0, 1] make it overshoot or diverge
+    if not 0 < settings.temp_smoothing <= 1:
+        raise ValueError(f"temp_smoothing ({settings.temp_smoothing}) must be above 0 and at most 1")
+    # A zero or negative interval would turn the realtime control loop into a busy spin,
+    # max_sleep_interval is never below sleep_interval
+    if not settings.sleep_interval > 0:
+        raise ValueError(f"sleep_interval ({settings.sleep_interval}) must be above 0")
+    if not settings.wattage_interval > 0:
+        raise ValueError(f"wattage_interval ({settings.wattage_interval}) must be above 0")
+    # The command line restricts the choices, the configuration file has to be checked here
+    if settings.fan_control not in ('curve', 'pi'):
+        raise ValueError(f"fan_control ({settings.fan_control}) must be curve or pi")
+
+try:
+    args = load_settings(cli_args)
+except (configparser.Error, ValueError) as e:
+    logging.error("Invalid settings in %s: %s", cli_args.config, e)
+    parser.error(f"invalid settings in {cli_args.config}: {e}")
+
+# CSV data log, kept open in append mode for the lifetime of the daemon. Rows are
+# handed to a writer thread so the control loop never blocks on disk I/O, which
+# collects them and writes up to DATA_LOG_BATCH_ROWS at once, at least every
+# DATA_LOG_FLUSH_INTERVAL seconds.
+DATA_LOG_BATCH_ROWS = 30
+DATA_LOG_FLUSH_INTERVAL = 30
+data_log_fd = None
+data_log_queue = queue.SimpleQueue()
+data_log_thread = None
+
+def data_log_writer():
+    done = False
+    while not done:
+        batch = [data_log_queue.get()]
+        deadline = time.monotonic() + DATA_LOG_FLUSH_INTERVAL
+        while batch[-1] is not None and len(batch) < DATA_LOG_BATCH_ROWS:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(data_log_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        # None is queued last by close_data_log to stop the writer
+        done = batch[-1] is None
+        if done:
+            batch.pop()
+        if batch:
+            try:
+                os.writev(data_log_fd, batch)
+            except OSError as e:
+                logging.error("Failed to write data log: %s", e)
+
+def open_data_log():
+    global data_log_fd, data_log_thread
+    data_log_fd = os.open(data_log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(data_log_fd, b"date,gpu_temp,fan_speed,pwm_value,gpu_power\n")
+    data_log_thread = threading.Thread(target=data_log_writer, name="baram-data-log", daemon=True)
+    data_log_thread.start()
+
+def close_data_log():
+    global data_log_fd, data_log_thread
+    if data_log_thread is not None:
+        data_log_queue.put(None)
+        data_log_thread.join()
+        data_log_thread = None
+    if data_log_fd is not None:
+        os.close(data_log_fd)
+        data_log_fd = None
+
+def log_data(timestamp, gpu_temp, fan_speed, pwm_value, gpu_power_mw):
+    # Rows are formatted straight to bytes, an unreadable fan speed is left empty
+    fan_field = b"" if fan_speed is None else b"%d" % fan_speed
+    data_log_queue.put(b"%s,%d,%s,%d,%.1f\n" % (timestamp.encode(), gpu_temp, fan_field, pwm_value, gpu_power_mw / 1000))
+
+def apply_settings(settings, pwm_table, spike_pwm_table):
+    # Copy the merged settings and the tables built from them into the module constants
+    # the control loop reads, so the hot path never goes through configparser. Runs at
+    # startup and again on SIGHUP, only after the settings and tables were all built.
+    global args, MIN_TEMP, MAX_TEMP, MIN_PWM, MAX_PWM, TEMP_DROP, TEMP_RISE
+    global PWM_STEP, WATTAGE_PWM, WATTAGE_SPIKE_COUNT, WATTAGE_INTERVAL, SLEEP_INTERVAL, MAX_SLEEP_INTERVAL
+    global TEMP_SMOOTHING, FAN_CONTROL, PI_TARGET_TEMP, PI_KP, PI_KI, PWM_HYSTERESIS
+    global WATTAGE_THRESHOLD_MW, PI_INTEGRAL_MAX, PWM_TABLE, SPIKE_PWM_TABLE
+    args = settings
+    MIN_TEMP = settings.min_temp
+    MAX_TEMP = settings.max_temp
+    MIN_PWM = settings.min_pwm_value
+    MAX_PWM = settings.max_pwm_value
+    TEMP_DROP = settings.temp_drop
+    TEMP_RISE = settings.temp_rise
+    PWM_STEP = settings.pwm_step
+    WATTAGE_PWM = settings.wattage_pwm_value
+    WATTAGE_SPIKE_COUNT = settings.wattage_spike_count
+    WATTAGE_INTERVAL = settings.wattage_interval
+    SLEEP_INTERVAL = settings.sleep_interval
+    MAX_SLEEP_INTERVAL = settings.max_sleep_interval
+    TEMP_SMOOTHING = settings.temp_smoothing
+    FAN_CONTROL = settings.fan_control
+    PI_TARGET_TEMP = settings.pi_target_temp
+    PI_KP = settings.pi_kp
+    PI_KI = settings.pi_ki
+    PWM_HYSTERESIS = settings.pwm_hysteresis
+
+    # Wattage threshold in milliwatts, as reported by NVML
+    WATTAGE_THRESHOLD_MW = settings.wattage_threshold * 1000
+
+    # Anti-windup limit, the integral term alone never asks for more than the full PWM range.
+    # The integral is also never negative, otherwise a long idle below the target winds it
+    # down and the fan stays at the minimum well above the target once load starts.
+    PI_INTEGRAL_MAX = MAX_PWM / PI_KI if PI_KI > 0 else 0.0
+
+    PWM_TABLE = pwm_table
+    SPIKE_PWM_TABLE = spike_pwm_table
 
 # PWM control file and fan speed file
 PWM_FILE = "/sys/class/hwmon/hwmon2/pwm1"
 FAN_SPEED_FILE = "/sys/class/hwmon/hwmon2/fan1_input"
 PWM_ENABLE_FILE = "/sys/class/hwmon/hwmon2/pwm1_enable"
 
-# Variables for tracking wattage spikes
-actual_min_pwm_value = args.min_pwm_value
-spike_count = 0
+# Readings within these deltas of the previous tick, with a PWM change of at most
+# pwm_step, count as steady. After STEADY_TICKS steady ticks the poll interval grows
+# by POLL_BACKOFF_FACTOR on every further steady tick, up to max_sleep_interval.
+STEADY_TEMP_DELTA = 1
+STEADY_POWER_DELTA_MW = 10000
+STEADY_TICKS = 5
+POLL_BACKOFF_FACTOR = 1.5
+
+# Ticks between checks that pwm1_enable is still in manual mode, in case another
+# tool (e.g. fancontrol or the BIOS) took the fan back
+PWM_MODE_CHECK_TICKS = 60
+
+# Within this many degrees of max_temp the poll interval never backs off
+HOT_TEMP_MARGIN = 5
+
+# Steady readings are written to the data log at most this often, in seconds
+DATA_LOG_IDLE_INTERVAL = 60
+
+# pwm1_enable mode found at startup, restored on exit
+current_mode = None
+
+def handle_exit_signal(signum, frame):
+    # Exit through SystemExit so the atexit handlers hand the fan back and release NVML
+    logging.info("Received signal %d, shutting down", signum)
+    sys.exit(0)
+
+def get_pwm_control_mode():
+    try:
+        return int(os.pread(PWM_ENABLE_FD, 8, 0))
+    except OSError as e:
+        logging.error("Failed to read PWM control mode: %s", e)
+        return None
 
 def set_pwm_control_mode(mode):
     try:
-        with open(PWM_ENABLE_FILE, "w") as file:
-            file.write(str(mode))
+        os.pwrite(PWM_ENABLE_FD, b"%d" % mode, 0)
         print(f"PWM control mode set to {mode}")
-    except IOError as e:
+    except OSError as e:
         print(f"Failed to set PWM control mode to {mode}: {str(e)}")
 
-def get_gpu_temp(handle):
-    temperature = nvmlDeviceGetTemperature(handle, NVML_TEMPERATURE_GPU)
-    return temperature
+def restore_pwm_control_mode():
+    # Hand the fan back to the mode it was in before Baram took it over, so it is not
+    # left pinned at the last PWM value once Baram stops
+    mode = current_mode if current_mode not in (None, 1) else args.restore_pwm_mode
+    if PWM_ENABLE_FD < 0:
+        # The hwmon files were lost and not reopened yet, try once more before giving up
+        try:
+            open_sysfs_files()
+        except OSError as e:
+            logging.error("Failed to restore PWM control mode, hwmon files unavailable: %s", e)
+            return
+    set_pwm_control_mode(mode)
+
+def set_manual_pwm_mode():
+    set_pwm_control_mode(1)
+    mode = get_pwm_control_mode()
+    if mode != 1:
+        logging.error("PWM control mode is %s after switching to manual", mode)
+
+# NVML sensor calls made on every tick, bound directly from libnvidia-ml so the
+# function pointers and output buffers are resolved once instead of per call
+_nvml_get_temperature = None
+_nvml_get_power_usage = None
+_temp_out = ctypes.c_uint()
+_power_out = ctypes.c_uint()
+_temp_ptr = ctypes.pointer(_temp_out)
+_power_ptr = ctypes.pointer(_power_out)
+
+def bind_nvml_sensors():
+    global _nvml_get_temperature, _nvml_get_power_usage
+    lib = ctypes.CDLL("libnvidia-ml.so.1")
+    _nvml_get_temperature = lib.nvmlDeviceGetTemperature
+    _nvml_get_temperature.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_uint)]
+    _nvml_get_temperature.restype = ctypes.c_int
+    _nvml_get_power_usage = lib.nvmlDeviceGetPowerUsage
+    _nvml_get_power_usage.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint)]
+    _nvml_get_power_usage.restype = ctypes.c_int
 
-def get_gpu_power(handle):
-    power = nvmlDeviceGetPowerUsage(handle) / 1000.0  # Convert milliwatts to watts
-    return power
+def get_gpu_temp(handle):
+    ret = _nvml_get_temperature(handle, NVML_TEMPERATURE_GPU, _temp_ptr)
+    if ret != NVML_SUCCESS:
+        raise NVMLError(ret)
+    return _temp_out.value
+
+def get_gpu_power_mw(handle):
+    # Power stays in integer milliwatts on the hot path, see WATTAGE_THRESHOLD_MW
+    ret = _nvml_get_power_usage(handle, _power_ptr)
+    if ret != NVML_SUCCESS:
+        raise NVMLError(ret)
+    return _power_out.value
+
+def enable_persistence_mode(handle):
+    # Without persistence mode the driver tears down and re-initializes the GPU state
+    # for every NVML client, making each query slow on an otherwise idle system
+    try:
+        if nvmlDeviceGetPersistenceMode(handle) != NVML_FEATURE_ENABLED:
+            nvmlDeviceSetPersistenceMode(handle, NVML_FEATURE_ENABLED)
+            logging.info("Enabled persistence mode on GPU %d", args.gpu_index)
+    except NVMLError as e:
+        logging.warning("Failed to enable persistence mode, consider running nvidia-persistenced: %s", e)
+
+# PCI runtime power state of the GPU, kept open so each tick is a single pread
+power_state_fd = None
+
+def open_power_state(handle):
+    global power_state_fd
+    pci = nvmlDeviceGetPciInfo(handle)
+    power_state_file = f"/sys/bus/pci/devices/{pci.domain:04x}:{pci.bus:02x}:{pci.device:02x}.0/power_state"
+    try:
+        power_state_fd = os.open(power_state_file, os.O_RDONLY)
+    except OSError as e:
+        logging.info("GPU power state not available, NVML will be polled every tick: %s", e)
+
+def close_power_state():
+    global power_state_fd
+    if power_state_fd is not None:
+        os.close(power_state_fd)
+        power_state_fd = None
+
+def gpu_is_awake():
+    # Reading sensors through NVML wakes a suspended GPU, so treat D3hot/D3cold as idle
+    if power_state_fd is None:
+        return True
+    try:
+        return not os.pread(power_state_fd, 8, 0).startswith(b"D3")
+    except OSError:
+        return True
+
+# sysfs file descriptors, opened once and reused with pread/pwrite at offset 0.
+# -1 marks a closed file, accessing it fails with EBADF, which makes the next tick
+# try to reopen the files.
+PWM_WR_FD = -1
+PWM_RD_FD = -1
+FAN_RD_FD = -1
+PWM_ENABLE_FD = -1
+
+def open_sysfs_files():
+    # All files are opened or none, a partially present device leaves everything closed
+    global PWM_WR_FD, PWM_RD_FD, FAN_RD_FD, PWM_ENABLE_FD
+    fds = []
+    try:
+        for path, flags in ((PWM_FILE, os.O_WRONLY), (PWM_FILE, os.O_RDONLY),
+                            (FAN_SPEED_FILE, os.O_RDONLY), (PWM_ENABLE_FILE, os.O_RDWR)):
+            fds.append(os.open(path, flags))
+    except OSError:
+        for fd in fds:
+            os.close(fd)
+        raise
+    PWM_WR_FD, PWM_RD_FD, FAN_RD_FD, PWM_ENABLE_FD = fds
+
+def close_sysfs_files():
+    global PWM_WR_FD, PWM_RD_FD, FAN_RD_FD, PWM_ENABLE_FD
+    for fd in (PWM_WR_FD, PWM_RD_FD, FAN_RD_FD, PWM_ENABLE_FD):
+        if fd >= 0:
+            os.close(fd)
+    PWM_WR_FD = PWM_RD_FD = FAN_RD_FD = PWM_ENABLE_FD = -1
+
+# Errors meaning the hwmon device went away, or that an earlier reopen found it still
+# missing and left the descriptors closed (EBADF). Other errors, e.g. from a fan header
+# that cannot report its speed, do not get better by reopening the files.
+HWMON_GONE_ERRNOS = (errno.ENODEV, errno.ENXIO, errno.ENOENT, errno.EBADF)
+
+def reopen_sysfs_files(e):
+    # The hwmon device can go away and come back (driver reload, suspend/resume),
+    # after which the old descriptors only return errors. Returns True if the files
+    # were reopened.
+    global last_written_pwm
+    if e.errno not in HWMON_GONE_ERRNOS:
+        return False
+    close_sysfs_files()
+    try:
+        open_sysfs_files()
+    except OSError as open_error:
+        logging.error("Failed to reopen hwmon files: %s", open_error)
+        return False
+    logging.info("Reopened hwmon files")
+    # The device was recreated with its default settings, take the fan back and write
+    # the next PWM value unconditionally
+    set_manual_pwm_mode()
+    last_written_pwm = None
+    return True
 
 def get_fan_speed():
     try:
-        with open(FAN_SPEED_FILE, "r") as file:
-            return int(file.read().strip())
-    except IOError as e:
+        return int(os.pread(FAN_RD_FD, 16, 0))
+    except OSError as e:
         print(f"Failed to read fan speed: {str(e)}")
+        reopen_sysfs_files(e)
         return None
 
+# Writes to the PWM file are slow round-trips to the fan controller, so the last
+# written value is remembered and unchanged values are not written again
+last_written_pwm = None
+
+# Value written on the previous tick that still has to be read back. Drivers like
+# nct6687 only refresh pwm1 every ~500 ms, so the check waits a tick instead of
+# stalling the loop right after the write.
+pending_pwm_check = None
+
 def set_pwm_value(value):
+    global last_written_pwm, pending_pwm_check
+    if value == last_written_pwm:
+        return
     try:
-        with open(PWM_FILE, "w") as file:
-            file.write(str(value))
-    except IOError as e:
+        os.pwrite(PWM_WR_FD, b"%d" % value, 0)
+    except OSError as e:
         print(f"Failed to write PWM value: {str(e)}")
+        reopen_sysfs_files(e)
+        # The value was not applied, write the next one unconditionally
+        last_written_pwm = None
+        return
+    last_written_pwm = value
+    pending_pwm_check = value
+
+def verify_pwm_value():
+    # Some drivers (e.g. nct6687) clamp the value, read it back to detect that
+    global pending_pwm_check
+    if pending_pwm_check is None:
+        return
+    current_value = get_current_pwm_value()
+    if current_value is not None and current_value != pending_pwm_check:
+        logging.warning("PWM value %d was not applied, driver reports %d", pending_pwm_check, current_value)
+    pending_pwm_check = None
 
 def get_current_pwm_value():
     try:
-        with open(PWM_FILE, "r") as file:
-            return int(file.read().strip())
-    except IOError as e:
+        return int(os.pread(PWM_RD_FD, 16, 0))
+    except OSError as e:
         print(f"Failed to read current PWM value: {str(e)}")
+        reopen_sysfs_files(e)
         return None
 
 def adjust_pwm_value(current_value, target_value, step):
-    if current_value < target_value:
-        return min(current_value + step, target_value)
-    elif current_value > target_value:
-        return max(current_value - step, target_value)
-    return current_value
-
-# Initialize NVML
-nvmlInit()
-
-# Get GPU handle
-gpu_index = 1  
-handle = nvmlDeviceGetHandleByIndex(gpu_index)
-
-# Check and set PWM control mode to manual (1)
-try:
-    with open(PWM_ENABLE_FILE, "r") as file:
-        current_mode = int(file.read().strip())
-except IOError as e:
-    logging.error(f"Failed to read PWM control mode: {str(e)}")
-
-if current_mode != 1:
-    set_pwm_control_mode(1)
-
-# Write CSV header to log file
-log_data(["date", "gpu_temp", "fan_speed", "pwm_value", "gpu_power"])
-
-pwm_value = args.min_pwm_value
-while True:
-    gpu_temp = get_gpu_temp(handle)
-    gpu_power = get_gpu_power(handle)
-    fan_speed = get_fan_speed()
-
-    if gpu_power >= args.wattage_threshold:
-        spike_count += 1
-        if spike_count > args.wattage_spike_count:
-            actual_min_pwm_value = args.wattage_pwm_value
-            logging.debug(f"Wattage spike detected. Setting minimum PWM value to {actual_min_pwm_value}.")
-    else:
-        if spike_count > 0:
-            spike_count -= 1
-            if spike_count == 0:
-                actual_min_pwm_value = args.min_pwm_value
-                logging.debug(f"Wattage spike ended. Resetting minimum PWM value to {actual_min_pwm_value}.")
-
-    # Temperature-based PWM adjustments
-    if gpu_temp < args.min_temp:
-        pwm_value = actual_min_pwm_value
-    else:
-        for i in range(len(TEMP_THRESHOLDS)):
-            if gpu_temp <= TEMP_THRESHOLDS[i]:
-                pwm_value = max(PWM_RANGES[i-1][1] + (gpu_temp - TEMP_THRESHOLDS[i-1]) * (PWM_RANGES[i][1] - PWM_RANGES[i-1][1]) // (TEMP_THRESHOLDS[i] - TEMP_THRESHOLDS[i-1]), actual_min_pwm_value)
-                break
+    # Move towards the target by at most step in either direction
+    return max(min(target_value, current_value + step), current_value - step)
+
+# GPU temperatures are small non-negative integers, so the fan curve is evaluated
+# once per temperature up front and the control loop only indexes the table
+PWM_TABLE_SIZE = 256
+
+def pwm_for_temp(gpu_temp, min_pwm_value, min_temp, temp_thresholds, pwm_ranges):
+    if gpu_temp < min_temp:
+        return min_pwm_value
+    for i in range(len(temp_thresholds)):
+        if gpu_temp <= temp_thresholds[i]:
+            return max(pwm_ranges[i-1][1] + (gpu_temp - temp_thresholds[i-1]) * (pwm_ranges[i][1] - pwm_ranges[i-1][1]) // (temp_thresholds[i] - temp_thresholds[i-1]), min_pwm_value)
+    return max(pwm_ranges[-1][1], min_pwm_value)
+
+def build_pwm_tables(settings):
+    # Define temperature and corresponding PWM values
+    temp_thresholds = [TEMP_CURVE_START, 40, 50, 60, 70, settings.max_temp]
+    pwm_ranges = [(0, 0), (0, 30), (30, 60), (60, 90), (90, 120), (120, settings.max_pwm_value)]
+
+    # One table for normal operation and one floored at the wattage spike PWM value, so
+    # a spike starting or ending only switches tables
+    return tuple(bytes(pwm_for_temp(t, min_pwm_value, settings.min_temp, temp_thresholds, pwm_ranges) for t in range(PWM_TABLE_SIZE))
+                 for min_pwm_value in (settings.min_pwm_value, settings.wattage_pwm_value))
+
+apply_settings(args, *build_pwm_tables(args))
+
+# Set by SIGHUP, the control loop reloads the configuration file at the start of the
+# next tick
+reload_requested = False
+
+def handle_reload_signal(signum, frame):
+    global reload_requested
+    reload_requested = True
+
+def reload_settings():
+    # gpu_index and the command line only options keep their startup values, the
+    # rest of the configuration file is applied to the running control loop
+    try:
+        settings = load_settings(cli_args)
+        settings.gpu_index = args.gpu_index
+        tables = build_pwm_tables(settings)
+    except (configparser.Error, ValueError, ArithmeticError) as e:
+        logging.error("Failed to reload %s, keeping the current settings: %s", cli_args.config, e)
+        return False
+    apply_settings(settings, *tables)
+    logging.info("Reloaded settings from %s", cli_args.config)
+    return True
+
+# Realtime priority for the control loop so ticks are not delayed under load
+RT_PRIORITY = 10
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+def enable_realtime():
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+    except OSError as e:
+        logging.warning("Failed to set realtime scheduling (needs CAP_SYS_NICE or LimitRTPRIO): %s", e)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        logging.warning("Failed to lock memory (needs CAP_IPC_LOCK or LimitMEMLOCK): %s", os.strerror(ctypes.get_errno()))
+
+# PI controller state for fan_control = pi
+pi_integral = 0.0
+pi_last_time = None
+
+def pi_pwm(gpu_temp, min_pwm_value, now):
+    global pi_integral, pi_last_time
+    dt = 0.0 if pi_last_time is None else now - pi_last_time
+    pi_last_time = now
+    err = gpu_temp - PI_TARGET_TEMP
+    pi_integral = min(max(pi_integral + err * dt, 0.0), PI_INTEGRAL_MAX)
+    out = PI_KP * err + PI_KI * pi_integral
+    return min(max(min_pwm_value + int(out), min_pwm_value), MAX_PWM)
+
+def pause_pi():
+    # Ticks without a temperature reading do not count towards the integral, the first
+    # reading afterwards starts a new interval instead of integrating over the gap
+    global pi_last_time
+    pi_last_time = None
+
+def wait_for_next_tick(next_tick, interval):
+    # Sleep until the next tick on the monotonic clock so the loop keeps a fixed
+    # cadence instead of drifting by the time spent in each iteration
+    next_tick += interval
+    delay = next_tick - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+        return next_tick
+    return time.monotonic()
+
+def main():
+    # Startup and the control loop run inside a function so the per-tick state is
+    # held in fast locals instead of module globals
+    global current_mode, last_written_pwm, reload_requested
+
+    # SIGTERM (systemctl stop) and SIGINT would otherwise skip the atexit cleanup
+    signal.signal(signal.SIGTERM, handle_exit_signal)
+    signal.signal(signal.SIGINT, handle_exit_signal)
+    signal.signal(signal.SIGHUP, handle_reload_signal)
+
+    # Initialize NVML, shut down at exit since the control loop never returns
+    nvmlInit()
+    atexit.register(nvmlShutdown)
+
+    # Get GPU handle
+    handle = nvmlDeviceGetHandleByIndex(args.gpu_index)
+    if not args.no_persistence_mode:
+        enable_persistence_mode(handle)
+    bind_nvml_sensors()
+    open_power_state(handle)
+    atexit.register(close_power_state)
+
+    # Keep the PWM, PWM enable and fan speed files open for the lifetime of the daemon
+    open_sysfs_files()
+    atexit.register(close_sysfs_files)
+
+    # Check and set PWM control mode to manual (1)
+    current_mode = get_pwm_control_mode()
+    if current_mode != 1:
+        set_manual_pwm_mode()
+    atexit.register(restore_pwm_control_mode)
+
+    # Start from the value the fan is actually running at, so the first tick does not
+    # rewrite it when it already matches
+    last_written_pwm = get_current_pwm_value()
+
+    # Open the data log and write the CSV header
+    open_data_log()
+    atexit.register(close_data_log)
+
+    # Only the control loop runs realtime, the data log writer thread started above keeps
+    # the normal scheduling policy
+    if not args.no_rt:
+        enable_realtime()
+
+    pwm_value = MIN_PWM
+    actual_min_pwm_value = MIN_PWM
+    pwm_table = PWM_TABLE
+    next_tick = time.monotonic()
+    poll_interval = SLEEP_INTERVAL
+    steady_count = 0
+    mode_check_count = 0
+    last_log_time = -DATA_LOG_IDLE_INTERVAL
+    # Force the first tick to count as a change
+    last_temp, last_power_mw, last_pwm_value = -1, -1, -1
+    # Variables for tracking wattage spikes. spike_times holds the monotonic times of
+    # the ticks within the last WATTAGE_INTERVAL seconds that were at or above the
+    # wattage threshold, so spikes are counted over a sliding window even when the
+    # poll interval changes.
+    spike_times = collections.deque()
+    spike_count = 0
+    temp_ema = None
+    # Temperature the fan curve was last moved to, see TEMP_RISE and TEMP_DROP
+    curve_temp = None
+    while True:
+        if reload_requested:
+            reload_requested = False
+            spiking = pwm_table is SPIKE_PWM_TABLE
+            if reload_settings():
+                # Pick up the rebuilt tables and limits, keeping an ongoing wattage spike
+                actual_min_pwm_value = WATTAGE_PWM if spiking else MIN_PWM
+                pwm_table = SPIKE_PWM_TABLE if spiking else PWM_TABLE
+                steady_count = 0
+                poll_interval = SLEEP_INTERVAL
+                # The PI controller may not have run since its last tick, e.g. after a
+                # switch to fan_control = curve and back, do not integrate over that time
+                pause_pi()
+
+        mode_check_count += 1
+        if mode_check_count >= PWM_MODE_CHECK_TICKS:
+            mode_check_count = 0
+            mode = get_pwm_control_mode()
+            if mode != 1:
+                logging.warning("PWM control mode changed to %s, switching back to manual", mode)
+                set_manual_pwm_mode()
+                # The driver may have changed the PWM value as well, write the next one unconditionally
+                last_written_pwm = None
+
+        # The sysfs files are read back to back at the start of the tick: the pwm1
+        # readback, the GPU power state and, unless the GPU is suspended, the fan speed
+        verify_pwm_value()
+
+        if not gpu_is_awake():
+            # GPU is suspended and therefore idle, hold the fan at the minimum without waking it.
+            # A suspended GPU draws no power, so any wattage spike is over as well.
+            spike_times.clear()
+            spike_count = 0
+            actual_min_pwm_value = MIN_PWM
+            pwm_table = PWM_TABLE
+            pwm_value = actual_min_pwm_value
+            set_pwm_value(pwm_value)
+            logging.debug("GPU suspended, PWM Value: %d", pwm_value)
+            # No reading this tick, the PI timer, smoothing and curve hysteresis restart from the next one
+            pause_pi()
+            temp_ema = curve_temp = None
+            next_tick = wait_for_next_tick(next_tick, MAX_SLEEP_INTERVAL)
+            continue
+
+        fan_speed = get_fan_speed()
+
+        try:
+            gpu_temp = get_gpu_temp(handle)
+            gpu_power_mw = get_gpu_power_mw(handle)
+        except NVMLError as e:
+            # Without a reading the GPU could be overheating, run the fan at full speed
+            # until NVML answers again instead of letting the exception stop the daemon
+            logging.warning("Failed to read GPU sensors, setting PWM to %d: %s", MAX_PWM, e)
+            set_pwm_value(MAX_PWM)
+            # No reading this tick, the PI timer, smoothing and curve hysteresis restart from the next one
+            pause_pi()
+            temp_ema = curve_temp = None
+            poll_interval = SLEEP_INTERVAL
+            steady_count = 0
+            next_tick = wait_for_next_tick(next_tick, poll_interval)
+            continue
+        now = time.monotonic()
+
+        if gpu_power_mw >= WATTAGE_THRESHOLD_MW:
+            spike_times.append(now)
+        while spike_times and now - spike_times[0] > WATTAGE_INTERVAL:
+            spike_times.popleft()
+        spike_count = len(spike_times)
+
+        if spike_count > WATTAGE_SPIKE_COUNT and actual_min_pwm_value != WATTAGE_PWM:
+            actual_min_pwm_value = WATTAGE_PWM
+            pwm_table = SPIKE_PWM_TABLE
+            logging.debug("Wattage spike detected. Setting minimum PWM value to %d.", actual_min_pwm_value)
+        elif spike_count == 0 and actual_min_pwm_value != MIN_PWM:
+            actual_min_pwm_value = MIN_PWM
+            pwm_table = PWM_TABLE
+            logging.debug("Wattage spike ended. Resetting minimum PWM value to %d.", actual_min_pwm_value)
+
+        # Fan decisions follow an exponential moving average of the temperature so sensor
+        # noise does not move the fan, the raw reading is still what gets logged
+        temp_ema = gpu_temp if temp_ema is None else TEMP_SMOOTHING * gpu_temp + (1 - TEMP_SMOOTHING) * temp_ema
+        control_temp = int(temp_ema + 0.5)
+
+        if FAN_CONTROL == "pi":
+            pwm_value = pi_pwm(control_temp, actual_min_pwm_value, now)
         else:
-            pwm_value = max(PWM_RANGES[-1][1], actual_min_pwm_value)
+            # Only move along the curve once the temperature has risen by TEMP_RISE or dropped
+            # by TEMP_DROP since the last move, so the fan does not hunt around one point
+            if curve_temp is None or control_temp >= curve_temp + TEMP_RISE or control_temp <= curve_temp - TEMP_DROP:
+                curve_temp = control_temp
 
-    # Ensure PWM value is not lower than the actual minimum PWM value
-    pwm_value = max(pwm_value, actual_min_pwm_value)
+            # Temperature-based PWM adjustments, already floored at the actual minimum PWM value
+            pwm_value = pwm_table[min(curve_temp, PWM_TABLE_SIZE - 1)]
 
-    # Adjust PWM value based on wattage
-    if gpu_power < args.wattage_threshold and pwm_value > actual_min_pwm_value:
-        pwm_value = max(pwm_value - args.pwm_step, actual_min_pwm_value)
+            # Adjust PWM value based on wattage
+            if gpu_power_mw < WATTAGE_THRESHOLD_MW and pwm_value > actual_min_pwm_value:
+                pwm_value = max(pwm_value - PWM_STEP, actual_min_pwm_value)
 
-    # Set the new PWM value
-    set_pwm_value(pwm_value)
-
-    # Logging the data
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-    log_data([timestamp, gpu_temp, fan_speed, pwm_value, gpu_power])
-    logging.debug(f"Timestamp: {timestamp}, GPU Temp: {gpu_temp}, Fan Speed: {fan_speed}, PWM Value: {pwm_value}, GPU Power: {gpu_power}")
+        # Set the new PWM value, small changes are held back so the fan does not hunt
+        if last_written_pwm is None or abs(pwm_value - last_written_pwm) >= PWM_HYSTERESIS:
+            set_pwm_value(pwm_value)
+        else:
+            pwm_value = last_written_pwm
+
+        sensors_changed = (abs(gpu_temp - last_temp) >= STEADY_TEMP_DELTA
+                           or abs(gpu_power_mw - last_power_mw) >= STEADY_POWER_DELTA_MW)
+        pwm_delta = abs(pwm_value - last_pwm_value)
+        changed = sensors_changed or pwm_delta != 0
+        last_temp, last_power_mw, last_pwm_value = gpu_temp, gpu_power_mw, pwm_value
+
+        # Logging the data, steady readings only once per DATA_LOG_IDLE_INTERVAL
+        if changed or now - last_log_time >= DATA_LOG_IDLE_INTERVAL:
+            last_log_time = now
+            timestamp = time.strftime("%Y-%m-%d-%H:%M:%S", time.localtime())
+            log_data(timestamp, gpu_temp, fan_speed, pwm_value, gpu_power_mw)
+            logging.debug("Timestamp: %s, GPU Temp: %d, Fan Speed: %s, PWM Value: %d, GPU Power: %d mW", timestamp, gpu_temp, fan_speed, pwm_value, gpu_power_mw)
+
+        # Back off while the readings are steady, return to the base interval on any change.
+        # Close to max_temp or while a wattage spike is being tracked, stay at the base interval.
+        if sensors_changed or pwm_delta > PWM_STEP or spike_count > 0 or gpu_temp >= MAX_TEMP - HOT_TEMP_MARGIN:
+            steady_count = 0
+            poll_interval = SLEEP_INTERVAL
+        else:
+            steady_count += 1
+            if steady_count >= STEADY_TICKS:
+                poll_interval = min(poll_interval * POLL_BACKOFF_FACTOR, MAX_SLEEP_INTERVAL)
 
-    time.sleep(args.sleep_interval)
+        next_tick = wait_for_next_tick(next_tick, poll_interval)
 
-# Shutdown NVML
-nvmlShutdown()
\ No newline at end of file
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        # The atexit handlers still hand the fan back and release NVML on the way
+        # out, make sure the cause ends up in baram.log and not only on stderr
+        logging.exception("Baram stopped on an unexpected error")
+        raise